@@ -1,17 +1,74 @@
 import asyncio
 import aiohttp
+import os
+from concurrent.futures import ProcessPoolExecutor
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin, urlparse
 import xml.etree.ElementTree as ET
+from lxml import etree
 import datetime
 import re
+import html
+import functools
 import logging
 import gzip
+import time
+import random
+import math
+from email.utils import parsedate_to_datetime
 import yaml
 import validators
-from urllib.robotparser import RobotFileParser
+from protego import Protego
 from aiolimiter import AsyncLimiter
 from pathlib import Path
+from array import array
+from dataclasses import dataclass, field
+from typing import Callable
+
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+try:
+    import brotli  # noqa: F401 - lets aiohttp decode br responses
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+try:
+    import uvloop
+except ImportError:
+    # uvloop is unavailable on Windows; the default event loop is used there
+    uvloop = None
+
+try:
+    from pybloom_live import ScalableBloomFilter
+except ImportError:
+    ScalableBloomFilter = None
+
+try:
+    import aiodns  # noqa: F401 - AsyncResolver requires it
+    from aiohttp.resolver import AsyncResolver
+except ImportError:
+    AsyncResolver = None
+
+REQUEST_HEADERS = {
+    'User-Agent': 'SitemapGenerator/2.0',
+    'Accept': 'text/html,application/xhtml+xml',
+    'Accept-Encoding': ACCEPT_ENCODING,
+    'Connection': 'keep-alive'
+}
+
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+RETRY_STATUSES = {429, 503}
+MAX_RETRY_AFTER = 60
+
+BAD_EXTENSION_RE = re.compile(r'\.(pdf|jpg|png|gif|zip|exe|docx)$', re.I)
+
+ROBOTS_CACHE_TTL = 3600
+ROBOTS_RETRY_TTL = 60
 
 # Configuration
 CONFIG = {
@@ -19,6 +76,10 @@ CONFIG = {
     'max_concurrent_requests': 10,
     'requests_per_second': 2,
     'max_depth': 3,
+    'max_page_bytes': 10 * 1024 * 1024,
+    'max_retries': 3,
+    'retry_backoff': 1.0,
+    'bloom_filter': False,
     'exclude_patterns': ['login', 'admin', 'wp-admin', 'logout'],
     'valid_extensions': ['.html', '.php', '.asp', '.aspx', '']
 }
@@ -36,104 +97,327 @@ def setup_logging(output_dir):
     return logging.getLogger(__name__)
 
 def load_config():
+    # Each crawl gets its own copy so one run's overrides don't leak into the next
+    config = dict(CONFIG)
     config_path = Path('sitemap_config.yaml')
     if config_path.exists():
         with open(config_path, 'r') as f:
             user_config = yaml.safe_load(f) or {}
-        CONFIG.update(user_config)
-    return CONFIG
+        config.update(user_config)
+    return config
 
 def validate_url(url):
     if not validators.url(url):
         raise ValueError("Invalid URL format. Please include protocol (http:// or https://)")
     return url.rstrip('/')
 
-async def check_robots_txt(url, session):
+async def fetch_robots_txt(robots_url, session):
+    """Fetch and parse robots.txt, returning the parser (or None) and how long to cache it."""
     logger = logging.getLogger(__name__)
-    parsed = urlparse(url)
-    robots_url = f"{parsed.scheme}://{parsed.netloc}/robots.txt"
-    rp = RobotFileParser()
     try:
         async with session.get(robots_url, timeout=5) as response:
             if response.status == 200:
                 text = await response.text()
-                rp.parse(text.splitlines())
+                rp = Protego.parse(text)
                 logger.info(f"Successfully parsed robots.txt from {robots_url}")
-                return rp
+                return rp, ROBOTS_CACHE_TTL
             else:
                 logger.warning(f"Failed to fetch robots.txt from {robots_url}: Status {response.status}")
-                return None
+                # Rate limiting and server errors are transient, so retry them sooner
+                transient = response.status == 429 or response.status >= 500
+                return None, ROBOTS_RETRY_TTL if transient else ROBOTS_CACHE_TTL
     except Exception as e:
         logger.warning(f"Could not read robots.txt from {robots_url}: {e}")
-        return None
+        return None, ROBOTS_RETRY_TTL
+
+class RobotsCache:
+    """robots.txt parsers for a single crawl, keyed by origin.
+    
+    Each crawl gets its own instance, so the per-origin locks never outlive the
+    event loop they were created on.
+    """
+    
+    def __init__(self):
+        # origin -> (parser or None, expiry on the monotonic clock)
+        self.entries = {}
+        self.locks = {}
+
+async def check_robots_txt(url, session, robots_cache):
+    parsed = urlparse(url)
+    origin = f"{parsed.scheme}://{parsed.netloc}"
+    
+    cached = robots_cache.entries.get(origin)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    
+    # One fetch per origin; concurrent callers wait for it and then hit the cache
+    async with robots_cache.locks.setdefault(origin, asyncio.Lock()):
+        cached = robots_cache.entries.get(origin)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        
+        rp, ttl = await fetch_robots_txt(f"{origin}/robots.txt", session)
+        robots_cache.entries[origin] = (rp, time.monotonic() + ttl)
+        return rp
+
+def absolute_url(href, base_url, base_parsed):
+    # Root-relative links only need the page's origin prepended; urljoin is much slower
+    if href.startswith('/') and not href.startswith('//') and '/.' not in href:
+        return f"{base_parsed.scheme}://{base_parsed.netloc}{href}"
+    return urljoin(base_url, href)
 
-def clean_url(url, base_url):
+def clean_url(url, base_netloc):
     parsed = urlparse(url)
-    clean = f"{parsed.scheme}://{parsed.netloc}{parsed.path}"
-    if urlparse(base_url).netloc != urlparse(clean).netloc:
+    if parsed.netloc != base_netloc:
         return None
-    return clean
+    return f"{parsed.scheme}://{parsed.netloc}{parsed.path}"
+
+def is_same_page(url_a, url_b):
+    """Compare cleaned URLs, treating an empty path and "/" as the same page."""
+    if url_a == url_b:
+        return True
+    parsed_a, parsed_b = urlparse(url_a), urlparse(url_b)
+    return parsed_a.netloc == parsed_b.netloc and (parsed_a.path or '/') == (parsed_b.path or '/')
 
-async def crawl_url(url, depth, session, robots_parser, visited, config, limiter):
-    if url in visited or depth > config['max_depth']:
-        return set()
+def parse_html(body, charset=None):
+    """Return the canonical href (or None) and the unique link hrefs in a page body.
     
-    visited.add(url)
+    The body is decoded with the charset from the Content-Type header when one was
+    sent; otherwise the raw bytes go to the parser, which detects the encoding.
+    """
+    if charset:
+        try:
+            body = body.decode(charset, errors='replace')
+        except LookupError:
+            pass
     
-    if robots_parser and not robots_parser.can_fetch("*", url):
-        logging.info(f"Skipping {url} - disallowed by robots.txt")
-        return set()
+    if HTMLParser:
+        tree = HTMLParser(body)
+        canonical = tree.css_first('link[rel~="canonical"]')
+        canonical_href = canonical.attributes.get('href') if canonical else None
+        # Navigation links repeat on every page, so dedupe before any URL work
+        hrefs = {node.attributes.get('href') for node in tree.css('a[href]')}
+        hrefs.discard(None)
+        return canonical_href, list(hrefs)
     
-    new_urls = set()
+    soup = BeautifulSoup(body, 'lxml')
+    canonical = soup.find('link', rel='canonical')
+    canonical_href = canonical.get('href') if canonical else None
+    return canonical_href, list({link['href'] for link in soup.find_all('a', href=True)})
+
+def build_url_filter(config):
+    """Compile the configured exclusions and extensions into a single URL predicate."""
+    exclude_re = re.compile('|'.join(map(re.escape, config['exclude_patterns']))) if config['exclude_patterns'] else None
+    valid_extensions = tuple(config['valid_extensions'])
+    
+    def url_filter(url):
+        return (not (exclude_re and exclude_re.search(url)) and
+                url.endswith(valid_extensions) and
+                not BAD_EXTENSION_RE.search(url))
     
-    async with limiter:
+    return url_filter
+
+def parse_retry_after(value):
+    """Return the delay in seconds requested by a Retry-After header, or None."""
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
         try:
-            async with session.get(url, headers={'User-Agent': 'SitemapGenerator/2.0'}) as response:
-                if response.status != 200 or 'text/html' not in response.headers.get('content-type', ''):
-                    return set()
-                
-                text = await response.text()
-                soup = BeautifulSoup(text, 'html.parser')
-                
-                # Check for canonical URL
-                canonical = soup.find('link', rel='canonical')
-                if canonical and canonical.get('href'):
-                    canonical_url = clean_url(canonical['href'], url)
-                    if canonical_url and canonical_url != url:
-                        visited.add(canonical_url)
-                        return set()
-                
-                # Calculate priority
-                priority = max(0.1, 0.8 - (depth * 0.1))
-                
-                # Add URL to sitemap data
-                sitemap_urls.append({
-                    'loc': url,
-                    'lastmod': datetime.datetime.now().strftime('%Y-%m-%d'),
-                    'changefreq': 'daily' if depth <= 1 else 'weekly',
-                    'priority': f"{priority:.1f}"
-                })
-                
-                # Find all links
-                for link in soup.find_all('a', href=True):
-                    href = link['href']
-                    absolute_url = urljoin(url, href)
-                    cleaned_url = clean_url(absolute_url, url)
-                    
-                    if (cleaned_url and 
-                        cleaned_url not in visited and
-                        not any(pattern in cleaned_url for pattern in config['exclude_patterns']) and
-                        any(cleaned_url.endswith(ext) for ext in config['valid_extensions']) and
-                        not re.search(r'\.(pdf|jpg|png|gif|zip|exe|docx)$', cleaned_url, re.I)):
-                        new_urls.add((cleaned_url, depth + 1))
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        # A "-0000" zone parses as a naive datetime; HTTP dates are always UTC
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+        delay = (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    if not math.isfinite(delay):
+        return None
+    return min(max(delay, 0), MAX_RETRY_AFTER)
+
+async def fetch_page(url, ctx):
+    """Return (body, charset) for an HTML page, or None, retrying transient failures with backoff."""
+    max_retries = ctx.config['max_retries']
+    backoff = ctx.config['retry_backoff']
+    
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        try:
+            async with ctx.semaphore:
+                # The rate limit only covers issuing the request, not reading or parsing it
+                async with ctx.limiter:
+                    response = await ctx.session.get(url, headers=REQUEST_HEADERS)
                 
-        except Exception as e:
-            logging.error(f"Error crawling {url}: {e}")
+                async with response:
+                    if response.status in RETRY_STATUSES:
+                        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                        error = f"Status {response.status}"
+                    elif response.status != 200 or 'text/html' not in response.headers.get('content-type', ''):
+                        return None
+                    elif (response.content_length or 0) > ctx.config['max_page_bytes']:
+                        logging.info(f"Skipping {url} - page larger than {ctx.config['max_page_bytes']} bytes")
+                        return None
+                    else:
+                        # Decoding is left to the parse worker; charset is None if the header has none
+                        return await response.read(), response.charset
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+            # ClientPayloadError covers connections reset while the body is being read
+            error = str(e) or type(e).__name__
+        
+        if attempt == max_retries:
+            break
+        
+        # Sleep outside the semaphore so waiting retries don't block other fetches
+        delay = retry_after if retry_after is not None else backoff * 2 ** attempt + random.uniform(0, backoff)
+        logging.warning(f"Retrying {url} in {delay:.1f}s after: {error}")
+        await asyncio.sleep(delay)
+    
+    ctx.failed.append(url)
+    logging.error(f"Giving up on {url} after {max_retries + 1} attempts: {error}")
+    return None
+
+async def crawl_url(url, depth, ctx):
+    new_urls = set()
+    
+    try:
+        robots_parser = await check_robots_txt(url, ctx.session, ctx.robots_cache)
+        if robots_parser and not robots_parser.can_fetch(url, "*"):
+            logging.info(f"Skipping {url} - disallowed by robots.txt")
+            return set()
+        
+        page = await fetch_page(url, ctx)
+        if page is None:
+            return set()
+        
+        # Parse in a worker process so the event loop keeps serving other fetches
+        loop = asyncio.get_running_loop()
+        canonical_href, hrefs = await loop.run_in_executor(ctx.parse_pool, parse_html, *page)
+        
+        base_parsed = urlparse(url)
+        
+        # Check for canonical URL
+        if canonical_href:
+            canonical_url = clean_url(absolute_url(canonical_href, url, base_parsed), base_parsed.netloc)
+            if canonical_url and not is_same_page(canonical_url, url):
+                # Crawl the canonical page in this page's place, unless it is already scheduled
+                if canonical_url not in ctx.visited and ctx.url_filter(canonical_url):
+                    ctx.visited.add(canonical_url)
+                    return {(canonical_url, depth)}
+                return set()
+        
+        # Add URL to sitemap data
+        ctx.entries.add(url, depth)
+        
+        # Find all links; pages at max depth have no children to schedule
+        if depth >= ctx.config['max_depth']:
+            return new_urls
+        
+        for href in hrefs:
+            link_url = absolute_url(href, url, base_parsed)
+            # Plain links are already in their cleaned form, so a hit here needs no parsing
+            if link_url in ctx.visited:
+                continue
+            
+            cleaned_url = clean_url(link_url, base_parsed.netloc)
+            
+            if cleaned_url and cleaned_url not in ctx.visited and ctx.url_filter(cleaned_url):
+                # Mark as seen on discovery so each URL is queued only once
+                ctx.visited.add(cleaned_url)
+                new_urls.add((cleaned_url, depth + 1))
+        
+    except Exception as e:
+        logging.error(f"Error crawling {url}: {e}")
     
     return new_urls
 
+async def crawl_worker(queue, ctx):
+    while True:
+        url, depth = await queue.get()
+        try:
+            new_urls = await crawl_url(url, depth, ctx)
+            for new_url, new_depth in new_urls:
+                queue.put_nowait((new_url, new_depth))
+        except Exception as e:
+            # Keep the worker alive; if every worker died, queue.join() would never return
+            logging.error(f"Worker error on {url}: {e}", exc_info=True)
+        finally:
+            queue.task_done()
+
+@functools.lru_cache(maxsize=None)
+def depth_metadata(depth):
+    """Return the shared (changefreq, priority) strings for a crawl depth."""
+    priority = max(0.1, 0.8 - (depth * 0.1))
+    return ('daily' if depth <= 1 else 'weekly'), f"{priority:.1f}"
+
+class SitemapEntries:
+    """Sitemap entries stored as parallel columns instead of one dict per URL.
+    
+    Only the URL and its crawl depth are kept per entry; lastmod is shared by the
+    whole crawl and changefreq/priority are derived from depth when rows are read.
+    """
+    
+    def __init__(self, lastmod):
+        self.lastmod = lastmod
+        self.locs = []
+        self.depths = array('H')
+    
+    def __len__(self):
+        return len(self.locs)
+    
+    def add(self, loc, depth):
+        self.locs.append(loc)
+        self.depths.append(depth)
+    
+    def sort(self):
+        order = sorted(range(len(self.locs)), key=self.locs.__getitem__)
+        self.locs = [self.locs[i] for i in order]
+        self.depths = array('H', (self.depths[i] for i in order))
+    
+    def rows(self, start=0, stop=None):
+        """Yield (loc, lastmod, changefreq, priority) tuples for entries start..stop."""
+        for i in range(start, len(self.locs) if stop is None else min(stop, len(self.locs))):
+            yield (self.locs[i], self.lastmod) + depth_metadata(self.depths[i])
+
+class SeenUrls:
+    """Set of URLs already scheduled, optionally backed by a Bloom filter.
+    
+    The Bloom filter uses a fraction of a set's memory on very large crawls. A
+    false positive can only cause a page to be skipped, never crawled twice.
+    """
+    
+    def __init__(self, urls=(), use_bloom=False):
+        if use_bloom and ScalableBloomFilter:
+            self.urls = ScalableBloomFilter(initial_capacity=100_000, error_rate=0.001)
+        else:
+            if use_bloom:
+                logging.warning("bloom_filter is enabled but pybloom_live is not installed; using a set")
+            self.urls = set()
+        for url in urls:
+            self.urls.add(url)
+    
+    def __contains__(self, url):
+        return url in self.urls
+    
+    def add(self, url):
+        self.urls.add(url)
+
+@dataclass
+class CrawlContext:
+    """State shared by the crawl workers of a single create_sitemap() run."""
+    session: aiohttp.ClientSession
+    config: dict
+    entries: SitemapEntries
+    visited: SeenUrls
+    url_filter: Callable[[str], bool]
+    limiter: AsyncLimiter
+    semaphore: asyncio.Semaphore
+    parse_pool: ProcessPoolExecutor
+    robots_cache: RobotsCache
+    failed: list = field(default_factory=list)
+
 def generate_html_sitemap(sitemap_urls, output_dir):
-    html_content = """
+    header = """
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -163,28 +447,58 @@ def generate_html_sitemap(sitemap_urls, output_dir):
             </tr>
     """
     
-    for url_data in sorted(sitemap_urls, key=lambda x: x['loc']):
-        html_content += f"""
+    row = """
             <tr>
-                <td><a href="{url_data['loc']}">{url_data['loc']}</a></td>
-                <td>{url_data['lastmod']}</td>
-                <td>{url_data['changefreq']}</td>
-                <td>{url_data['priority']}</td>
+                <td><a href="{loc}">{loc}</a></td>
+                <td>{lastmod}</td>
+                <td>{changefreq}</td>
+                <td>{priority}</td>
             </tr>
         """
     
-    html_content += """
+    footer = """
         </table>
     </body>
     </html>
     """
     
+    # Stream rows straight to the file instead of growing one string per URL
     html_filename = output_dir / 'sitemap.html'
-    with open(html_filename, 'w', encoding='utf-8') as f:
-        f.write(html_content)
+    with open(html_filename, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        f.write(header)
+        f.writelines(row.format(loc=html.escape(loc), lastmod=lastmod, changefreq=changefreq, priority=priority)
+                     for loc, lastmod, changefreq, priority in sitemap_urls.rows())
+        f.write(footer)
     
     logging.getLogger(__name__).info(f"HTML sitemap generated at {html_filename}")
 
+class TeeWriter:
+    """Minimal binary file-like object that writes the same bytes to several files."""
+    
+    def __init__(self, *files):
+        self.files = files
+    
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+        return len(data)
+
+def write_urlset(rows, sitemap_filename):
+    """Stream a <urlset> document to sitemap_filename and its .gz copy in a single pass."""
+    def tag(name):
+        return f"{{{SITEMAP_NS}}}{name}"
+    
+    with open(sitemap_filename, 'wb') as plain_file, \
+            gzip.open(sitemap_filename.with_suffix('.xml.gz'), 'wb', compresslevel=6) as gz_file, \
+            etree.xmlfile(TeeWriter(plain_file, gz_file), encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element(tag('urlset'), nsmap={None: SITEMAP_NS}):
+            for row in rows:
+                with xf.element(tag('url')):
+                    for name, value in zip(('loc', 'lastmod', 'changefreq', 'priority'), row):
+                        with xf.element(tag(name)):
+                            xf.write(value)
+
 async def create_sitemap():
     config = load_config()
     
@@ -202,24 +516,54 @@ async def create_sitemap():
         logger = setup_logging(output_dir)
         
         # Initialize
-        global sitemap_urls
-        sitemap_urls = []
-        visited = set()
-        limiter = AsyncLimiter(config['requests_per_second'], 1)
+        sitemap_urls = SitemapEntries(lastmod=datetime.date.today().isoformat())
+        # Reuse keep-alive connections and cap connections per host for the whole crawl
+        connector = aiohttp.TCPConnector(
+            limit=config['max_concurrent_requests'] * 4,
+            limit_per_host=config['max_concurrent_requests'],
+            ttl_dns_cache=300,
+            use_dns_cache=True,
+            enable_cleanup_closed=True,
+            keepalive_timeout=30,
+            resolver=AsyncResolver() if AsyncResolver else None
+        )
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=15)
+        
+        robots_cache = RobotsCache()
         
-        async with aiohttp.ClientSession() as session:
-            robots_parser = await check_robots_txt(site_url, session)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            # Warm the robots.txt cache before the workers start
+            await check_robots_txt(site_url, session, robots_cache)
             
-            # Start crawling
-            tasks = [crawl_url(site_url, 0, session, robots_parser, visited, config, limiter)]
+            # Start crawling with a fixed pool of workers sharing one queue
+            queue = asyncio.Queue()
+            await queue.put((site_url, 0))
+            
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as parse_pool:
+                ctx = CrawlContext(
+                    session=session,
+                    config=config,
+                    entries=sitemap_urls,
+                    # validate_url strips the trailing slash, so links to "/" must also count as seen
+                    visited=SeenUrls([site_url, site_url + '/'] if not urlparse(site_url).path else [site_url],
+                                     use_bloom=config['bloom_filter']),
+                    url_filter=build_url_filter(config),
+                    limiter=AsyncLimiter(config['requests_per_second'], 1),
+                    semaphore=asyncio.Semaphore(config['max_concurrent_requests']),
+                    parse_pool=parse_pool,
+                    robots_cache=robots_cache
+                )
+                workers = [asyncio.create_task(crawl_worker(queue, ctx))
+                           for _ in range(config['max_concurrent_requests'])]
+                
+                await queue.join()
+                
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
             
-            while tasks:
-                new_tasks = []
-                for future in asyncio.as_completed(tasks):
-                    new_urls = await future
-                    new_tasks.extend([crawl_url(url, depth, session, robots_parser, visited, config, limiter) 
-                                    for url, depth in new_urls])
-                tasks = new_tasks
+            if ctx.failed:
+                logger.warning(f"{len(ctx.failed)} URLs could not be fetched after retries: {', '.join(ctx.failed)}")
             
             # Generate sitemap(s)
             if not sitemap_urls:
@@ -227,40 +571,29 @@ async def create_sitemap():
                 print("No URLs found to include in sitemap")
                 return
             
+            # Sort once; the HTML sitemap and every XML chunk reuse this order
+            sitemap_urls.sort()
+            
             # Generate HTML sitemap
             generate_html_sitemap(sitemap_urls, output_dir)
             
             # Split into multiple sitemaps if needed
-            sitemap_chunks = [sitemap_urls[i:i + config['max_urls_per_sitemap']] 
-                            for i in range(0, len(sitemap_urls), config['max_urls_per_sitemap'])]
+            sitemap_chunks = [sitemap_urls.rows(i, i + config['max_urls_per_sitemap'])
+                              for i in range(0, len(sitemap_urls), config['max_urls_per_sitemap'])]
             
             if len(sitemap_chunks) > 1:
                 # Create sitemap index
-                sitemap_index = ET.Element('sitemapindex', xmlns="http://www.sitemaps.org/schemas/sitemap/0.9")
+                sitemap_index = ET.Element('sitemapindex', xmlns=SITEMAP_NS)
                 
                 for i, chunk in enumerate(sitemap_chunks, 1):
                     # Create individual sitemap
-                    urlset = ET.Element('urlset', xmlns="http://www.sitemaps.org/schemas/sitemap/0.9")
-                    for url_data in sorted(chunk, key=lambda x: x['loc']):
-                        url = ET.SubElement(urlset, 'url')
-                        ET.SubElement(url, 'loc').text = url_data['loc']
-                        ET.SubElement(url, 'lastmod').text = url_data['lastmod']
-                        ET.SubElement(url, 'changefreq').text = url_data['changefreq']
-                        ET.SubElement(url, 'priority').text = url_data['priority']
-                    
                     sitemap_filename = output_dir / f"sitemap-{i}.xml"
-                    tree = ET.ElementTree(urlset)
-                    tree.write(sitemap_filename, encoding='utf-8', xml_declaration=True)
-                    
-                    # Compress sitemap
-                    with open(sitemap_filename, 'rb') as f_in:
-                        with gzip.open(sitemap_filename.with_suffix('.xml.gz'), 'wb') as f_out:
-                            f_out.writelines(f_in)
+                    write_urlset(chunk, sitemap_filename)
                     
                     # Add to sitemap index
                     sitemap = ET.SubElement(sitemap_index, 'sitemap')
                     ET.SubElement(sitemap, 'loc').text = f"{site_url}/{sitemap_filename.name}.gz"
-                    ET.SubElement(sitemap, 'lastmod').text = datetime.datetime.now().strftime('%Y-%m-%d')
+                    ET.SubElement(sitemap, 'lastmod').text = sitemap_urls.lastmod
                 
                 # Save sitemap index
                 sitemap_index_filename = output_dir / 'sitemap.xml'
@@ -272,22 +605,8 @@ async def create_sitemap():
             
             else:
                 # Create single sitemap
-                urlset = ET.Element('urlset', xmlns="http://www.sitemaps.org/schemas/sitemap/0.9")
-                for url_data in sorted(sitemap_urls, key=lambda x: x['loc']):
-                    url = ET.SubElement(urlset, 'url')
-                    ET.SubElement(url, 'loc').text = url_data['loc']
-                    ET.SubElement(url, 'lastmod').text = url_data['lastmod']
-                    ET.SubElement(url, 'changefreq').text = url_data['changefreq']
-                    ET.SubElement(url, 'priority').text = url_data['priority']
-                
                 sitemap_filename = output_dir / 'sitemap.xml'
-                tree = ET.ElementTree(urlset)
-                tree.write(sitemap_filename, encoding='utf-8', xml_declaration=True)
-                
-                # Compress sitemap
-                with open(sitemap_filename, 'rb') as f_in:
-                    with gzip.open(sitemap_filename.with_suffix('.xml.gz'), 'wb') as f_out:
-                        f_out.writelines(f_in)
+                write_urlset(sitemap_urls.rows(), sitemap_filename)
                 
                 logger.info(f"Sitemap generated with {len(sitemap_urls)} URLs in {output_dir}")
                 print(f"Sitemap generated with {len(sitemap_urls)} URLs")
@@ -304,4 +623,11 @@ async def create_sitemap():
         print(f"An unexpected error occurred: {e}")
 
 if __name__ == "__main__":
-    asyncio.run(create_sitemap())
\ No newline at end of file
+    if uvloop and hasattr(uvloop, 'run'):
+        uvloop.run(create_sitemap())
+    elif uvloop:
+        # uvloop.run() was added in uvloop 0.18; older releases only offer the deprecated policy API
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.run(create_sitemap())
+    else:
+        asyncio.run(create_sitemap())
\ No newline at end of file